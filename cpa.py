@@ -1,16 +1,29 @@
 from typing import List, Dict, Optional
 from pydantic import BaseModel, Field
 from IPython.display import display
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import lru_cache
+from operator import attrgetter
 import matplotlib.pyplot as plt
 from io import BytesIO
 from PIL import Image
 import pandas as pd
+import numpy as np
 import anthropic
+import orjson
+import asyncio
 import base64
 import json
+import threading
+import time
 import os
 
+# with Copy-on-Write a shallow copy only duplicates the columns that are later written to,
+# it's always on from pandas 3 and opt-in for pandas 2, older versions need a full copy
+_copy_on_write = int(pd.__version__.split(".")[0]) >= 2
+if pd.__version__.startswith("2."):
+    pd.options.mode.copy_on_write = True
+
 class DataFrameOperation(BaseModel):
     """Call a member function of a Pandas DataFrame in the "stack". 
     
@@ -79,25 +92,30 @@ tools = {"pop":Pop,
          "series_operation":SeriesOperation,
          "series_assign":SeriesAssign}
 
-tool_schemas = []
-for name, cls in tools.items():
-    schema = json.loads(cls.schema_json())
-    for _, d in schema["properties"].items():
-        d.pop("title")
+def _build_tool_schemas():
+    _tool_schemas = []
+    for name, cls in tools.items():
+        # pydantic v2 renamed schema() to model_json_schema(), both return the dict directly
+        schema = cls.model_json_schema() if hasattr(cls, "model_json_schema") else cls.schema()
+        properties = {k: {kk: vv for kk, vv in d.items() if kk != "title"}
+                      for k, d in schema["properties"].items()}
+
+        _tool_schema = { "name":name,
+                              "description": schema["description"],
+                              "input_schema" : {
+                                  "type":"object",
+                                  "properties":properties,
+                                  #"required":schema["required"]
+                              }
+        }
 
-    _tool_schema = { "name":name,
-                          "description": schema["description"],
-                          "input_schema" : {
-                              "type":"object",
-                              "properties":schema["properties"],
-                              #"required":schema["required"]
-                          }
-    }
+        if "required" in schema:
+            _tool_schema["input_schema"]["required"] = schema["required"]
 
-    if "required" in schema:
-        _tool_schema["input_schema"]["required"] = schema["required"]
+        _tool_schemas.append(_tool_schema)
+    return _tool_schemas
 
-    tool_schemas.append(_tool_schema)
+tool_schemas = _build_tool_schemas()
 
 @dataclass
 class State:
@@ -106,6 +124,9 @@ class State:
     series : pd.Series
     steps : List
     tool_call : bool
+    repr_cache : Dict[int, str] = field(default_factory=dict)
+    interactive : bool = True
+    history_window : Optional[int] = None
 
 _system = """You are acting as a data analysis agent, working with python's Pandas package to fullfill a user request."""
 
@@ -119,11 +140,86 @@ When you have determined the final answer to the user request, or are stuck and
 final reply without using a tool.
 """
 
-def init(user_request : str, csv_file : str):
-
-    df = pd.read_csv(csv_file)
+_preview_rows = 10
+_preview_columns = 20
+
+def _frame_preview(df):
+    # a full __repr__ of a large frame still walks its index and blocks, the head is all the model needs.
+    # Like __repr__ the width is capped too, otherwise wide frames would be re-sent whole every turn.
+    # CSV drops the column padding of to_string(), which is just whitespace tokens in the prompt
+    if not isinstance(df, pd.DataFrame):
+        return df.__repr__()
+    dtypes = ", ".join(f"{c}: {t}" for c, t in df.dtypes.iloc[:_preview_columns].items())
+    hidden = df.shape[1] - _preview_columns
+    if hidden > 0:
+        dtypes += f", ... {hidden} more columns"
+    return f"shape={df.shape}, dtypes=({dtypes})\n{df.iloc[:_preview_rows, :_preview_columns].to_csv().rstrip()}"
+
+def _series_preview(series):
+    if not isinstance(series, pd.Series):
+        return series.__repr__()
+    return f"length={len(series)}, dtype={series.dtype}\n{series.head(_preview_rows).to_csv().rstrip()}"
+
+def _stack_repr(stack, repr_cache):
+    # frames are keyed by id() so only elements that are new (or were invalidated after
+    # being mutated) get rendered again, the rest of the stack reuses its cached repr
+    for df in stack:
+        if id(df) not in repr_cache:
+            repr_cache[id(df)] = _frame_preview(df)
+    return "\n\n".join([f"<stack element {n}>\n{repr_cache[id(df)]}\n</stack element {n}>" for n,df in enumerate(stack)][::-1])
+
+def _int32_dtype(dtype):
+    if isinstance(dtype, pd.ArrowDtype):
+        return "int32[pyarrow]"
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        return "Int32"
+    return "int32"
+
+def _shrink_dtypes(df):
+    # opt-in through init(shrink_dtypes=True): narrower types make the frame smaller and the following
+    # operations faster, but later arithmetic keeps the narrow dtype. int32 results can wrap silently
+    # (e.g. a timestamp * 1000) and float32 math keeps only ~7 digits, which the agent would report as
+    # its results, so the default is to keep read_csv's int64/float64.
+    # Text columns are left alone, as categories fillna/replace with a new label raises
+    int32 = np.iinfo(np.int32)
+    for c in df.columns:
+        col = df[c]
+        if pd.api.types.is_bool_dtype(col):
+            continue
+        if pd.api.types.is_integer_dtype(col):
+            if col.dtype.itemsize > 4 and col.notna().any() and int32.min <= col.min() and col.max() <= int32.max:
+                df[c] = col.astype(_int32_dtype(col.dtype))
+        elif pd.api.types.is_float_dtype(col):
+            down = pd.to_numeric(col, downcast="float")
+            if np.array_equal(down.to_numpy(dtype="float64", na_value=np.nan),
+                              col.to_numpy(dtype="float64", na_value=np.nan), equal_nan=True):
+                df[c] = down
+    return df
+
+# the tools, system prompt and preamble are identical on every call, so they're marked as cache
+# breakpoints and the server can reuse them instead of prefilling them again each turn
+_system_blocks = [{"type": "text", "text": _system, "cache_control": {"type": "ephemeral"}}]
+_prompt_caching_headers = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+def init(user_request : str, csv_file : str, interactive : bool = True, shrink_dtypes : bool = False):
+
+    df = None
+    # multithreaded parsing into Arrow-backed columns when pyarrow is installed. Only tried for paths,
+    # a file-like object would already be consumed by the time we need to fall back
+    if isinstance(csv_file, (str, os.PathLike)):
+        try:
+            df = pd.read_csv(csv_file, engine="pyarrow", dtype_backend="pyarrow")
+        except (ImportError, TypeError, ValueError):
+            # no pyarrow, a pandas older than 2.0 without dtype_backend, or a file the stricter
+            # pyarrow parser rejects (e.g. short rows) that the default engine can still read
+            pass
+    if df is None:
+        df = pd.read_csv(csv_file)
+    if shrink_dtypes:
+        df = _shrink_dtypes(df)
     stack = [df]
-    stack_repr = "\n\n".join([f"<stack element {n}>\n{df.__repr__()}\n</stack element {n}>" for n,df in enumerate(stack)][::-1])
+    repr_cache = {}
+    stack_repr = _stack_repr(stack, repr_cache)
     series = None
     steps = []
 
@@ -133,14 +229,19 @@ def init(user_request : str, csv_file : str):
             "content": [
                 {
                     "type": "text",
-                    "text": _preamble + f"""
+                    "text": _preamble,
+                    "cache_control": {"type": "ephemeral"},
+                },
+                {
+                    "type": "text",
+                    "text": f"""
                     User request: {json.dumps(user_request)}
                     Stack and Register
                     <stack>
                     {stack_repr}
                     </stack>
                     <series register>
-                    {series.__repr__()}
+                    {_series_preview(series)}
                     </series register>
                     """
                 },
@@ -153,30 +254,139 @@ def init(user_request : str, csv_file : str):
                     series=series,
                     steps=steps,
                     tool_call=True,
+                    repr_cache=repr_cache,
+                    interactive=interactive,
                     )
 
 
-def _resolve(base, function):
-    path = function.split(".")
-    new_base = getattr(base, path[0])
-    if len(path) == 1:
-        return new_base 
-    return _resolve(new_base, ".".join(path[1:]))
+# dotted paths like plot.bar are resolved by attrgetter, one getter per distinct function string
+_getter = lru_cache(maxsize=128)(attrgetter)
 
-def step(state):
-    client = anthropic.Anthropic()
-    message = client.messages.create(
+# pyplot keeps one global figure registry, so only one state handles its tool call at a time
+_handle_lock = threading.Lock()
+
+def _locked_handle_response(state, message):
+    with _handle_lock:
+        _handle_response(state, message)
+
+def _request_params(state):
+    return dict(
         model="claude-3-5-sonnet-20240620",
         max_tokens=2048,
         temperature=0,
-        system=_system,
+        system=_system_blocks,
         tools = tool_schemas,
         tool_choice = {"type": "auto", "disable_parallel_tool_use":True,},
         messages=state.messages
     )
 
+def step(state):
+    client = anthropic.Anthropic()
+    message = client.messages.create(**_request_params(state), extra_headers=_prompt_caching_headers)
+    _handle_response(state, message)
+
+async def astep(state, client=None):
+    """Async version of step(). The LLM call goes through AsyncAnthropic and the pandas work
+    runs in a worker thread, so several states can be stepped concurrently with run_many().
+    The state must be non-interactive (init(..., interactive=False)), display() and plt.show()
+    aren't reliable off the main thread. Pass an AsyncAnthropic client to reuse its connections,
+    otherwise one is created and closed for this call.
+    """
+    if state.interactive:
+        raise ValueError("astep/run_many need a non-interactive state, create it with init(..., interactive=False)")
+    if client is None:
+        async with anthropic.AsyncAnthropic() as client:
+            message = await client.messages.create(**_request_params(state), extra_headers=_prompt_caching_headers)
+    else:
+        message = await client.messages.create(**_request_params(state), extra_headers=_prompt_caching_headers)
+    await asyncio.to_thread(_locked_handle_response, state, message)
+
+async def run_many(states):
+    """Run each state until it stops calling tools, with all the sessions in flight at once.
+    The states must be non-interactive, see astep(). A failing session doesn't stop the others,
+    returns a list with None or the raised exception for each state.
+    """
+    if any(s.interactive for s in states):
+        raise ValueError("astep/run_many need non-interactive states, create them with init(..., interactive=False)")
+    async def _run(state, client):
+        while state.tool_call:
+            await astep(state, client)
+
+    # one client for all the sessions so they share its connection pool
+    async with anthropic.AsyncAnthropic() as client:
+        return await asyncio.gather(*[_run(s, client) for s in states], return_exceptions=True)
+
+def step_batch(states, poll_interval=10):
+    """Run one step for each state that still has a pending tool call, submitting all of the
+    requests together through the Message Batches API. Meant for offline runs over many
+    sessions; batches can take a while to process so interactive use should stick with step().
+    """
+    pending = {str(n): s for n, s in enumerate(states) if s.tool_call}
+    if not pending:
+        return
+
+    client = anthropic.Anthropic()
+    batch = client.messages.batches.create(
+        requests=[{"custom_id": custom_id, "params": _request_params(s)} for custom_id, s in pending.items()]
+    )
+    while batch.processing_status != "ended":
+        time.sleep(poll_interval)
+        batch = client.messages.batches.retrieve(batch.id)
+
+    for result in client.messages.batches.results(batch.id):
+        state = pending[result.custom_id]
+        if result.result.type == "succeeded":
+            _handle_response(state, result.result.message)
+        else:
+            # errored, canceled or expired, nothing to append so stop the session
+            print(f"{result.custom_id}: {result.result.type}")
+            state.tool_call = False
+
+def _do_pop(state, op):
+    _popped = state.stack.pop()
+    state.repr_cache.pop(id(_popped), None)
+    return _popped.__repr__(), None
+
+def _do_series_assign(state, op):
+    if not op.in_place:
+        state.stack.append(state.stack[-1].copy(deep=not _copy_on_write))
+
+    state.stack[-1][op.column_name] = state.series
+    state.repr_cache.pop(id(state.stack[-1]), None)
+    return state.stack[-1].__repr__(), None
+
+def _do_dataframe_operation(state, op):
+    if not -len(state.stack) <= op.target_frame < len(state.stack):
+        raise IndexError(f"target_frame {op.target_frame} is not on the stack, which has {len(state.stack)} elements")
+    _target = state.stack[op.target_frame]
+    # the call may modify the frame in place (e.g. inplace=True), so drop its cached repr
+    state.repr_cache.pop(id(_target), None)
+    _res = _getter(op.function)(_target)(**op.kwargs)
+    return _res.__repr__(), _res
+
+def _do_series_operation(state, op):
+    _res = _getter(op.function)(state.series)(**op.kwargs)
+    return _res.__repr__(), _res
+
+# each handler takes the validated tool model and returns the string shown to the model and the raw result (None if there's nothing to keep)
+DISPATCH = {"pop":_do_pop,
+            "dataframe_operation":_do_dataframe_operation,
+            "series_operation":_do_series_operation,
+            "series_assign":_do_series_assign}
+
+def _truncate_history(state):
+    # opt-in: messages are the initial request followed by (tool_use, tool_result) pairs, keep only the
+    # last history_window pairs, dropping each pair together so every tool_result still has its tool_use.
+    # Results only shown in a dropped tool_result (scalars, earlier registers, rows past the stack
+    # preview) are gone for the model
+    if state.history_window is None:
+        return
+    while len(state.messages) > 1 + 2 * state.history_window:
+        del state.messages[1:3]
+
+def _handle_response(state, message):
     #this happens regardless
-    response_dict= json.loads(message.json())
+    response_dict= orjson.loads(message.json())
     state.messages.append({"role":"assistant", "content":response_dict["content"]})
     
     msg_text = ""
@@ -197,63 +407,39 @@ def step(state):
             tool_name = c.name
             tool_input = c.input
             tool_id = c.id
-            step_texts.append(tool_name + ": " + json.dumps(tool_input))
+            step_texts.append(tool_name + ": " + orjson.dumps(tool_input).decode())
             print(tool_name)
             print(tool_input)
 
     _res = None
  
     if tool_name:
-        if tool_name == "pop":
-            res = state.stack.pop().__repr__()
-
-        elif tool_name == "series_assign":
-            if "in_place" in tool_input and not tool_input["in_place"]:
-                state.stack.append(state.stack[-1].copy())
-                
-            state.stack[-1][tool_input["column_name"]] = state.series
-            res = state.stack[-1].__repr__()
-        
-        elif tool_name == "dataframe_operation":
-            #if tool_input["function"] == "groupby":
-            #    _res = None
-            #    res = "Error: groupby cannot be used here, it does not return a dataframe it returns a grou
-            try:
-                _res = _resolve(state.stack[tool_input["target_frame"]], tool_input["function"])(**tool_input["kwargs"])
-                #_res = getattr(state.stack[tool_input["target_frame"]], tool_input["function"])(**tool_input["kwargs"])
-                res = _res.__repr__()
-            except Exception as e:
-                res = e.__repr__()
-                step_texts.append(res)
-                print(res)
-                
-                
-        elif tool_name == "series_operation":
-            try:
-                #_res = getattr(state.series, tool_input["function"])(**tool_input["kwargs"])
-                _res = _resolve(state.series, tool_input["function"])(**tool_input["kwargs"])
-                res = _res.__repr__()
-            except Exception as e:
-                res = e.__repr__()
-                step_texts.append(res)
-                print(res)
-            
-        
+        try:
+            # validating against the tool's model first rejects malformed calls before they reach pandas
+            op = tools[tool_name](**tool_input)
+            res, _res = DISPATCH[tool_name](state, op)
+        except Exception as e:
+            res = e.__repr__()
+            step_texts.append(res)
+            print(res)
+
         if isinstance(_res, pd.DataFrame) or isinstance(_res,pd.api.typing.DataFrameGroupBy):
                 state.stack.append(_res)
                 step_texts.append("Dataframe\n"+_res.head().__repr__()+"...")
                 print("Dataframe")
-                display(_res.head(5))
+                if state.interactive:
+                    display(_res.head(5))
                 print("...")
         elif isinstance(_res, pd.Series):
                 state.series = _res
                 step_texts.append("Series\n"+_res.head().__repr__()+"...")    
                 print("Series:")
-                display(_res.head())
+                if state.interactive:
+                    display(_res.head())
                 print("...")
 
         #only happens with a tool call
-        stack_repr = "\n\n".join([f"<stack element {n}>\n{df.__repr__()}\n</stack element {n}>" for n,df in enumerate(state.stack)][::-1])
+        stack_repr = _stack_repr(state.stack, state.repr_cache)
         _state =  f"""
         
         Stack and Register
@@ -261,7 +447,7 @@ def step(state):
                     {stack_repr}
                     </stack>
                     <series register>
-                    {state.series.__repr__()}
+                    {_series_preview(state.series)}
                     </series register>"""
 
         step_data = {"text":"\n\n".join(step_texts)}
@@ -271,10 +457,13 @@ def step(state):
         if plt.get_fignums():
             # encode as base64
             output = BytesIO()
-            plt.savefig(output, format='png')
-            plt.show()
-            im_data = output.getvalue()
-            image_data = base64.b64encode(im_data).decode("utf-8")
+            plt.savefig(output, format='png', dpi=100, bbox_inches='tight', pil_kwargs={'optimize': True})
+            if state.interactive:
+                plt.show()
+            plt.close('all')
+            # encode straight from the buffer's memory (the SDK needs a str for "data") and free it right away
+            image_data = base64.b64encode(output.getbuffer()).decode("ascii")
+            output.close()
 
             step_data["image"] = image_data
             
@@ -298,6 +487,7 @@ def step(state):
         
         
         state.messages.append({"role":"user", "content":tool_response})
+        _truncate_history(state)
         state.steps.append(step_data)
     
 